@@ -1,12 +1,17 @@
 # app.py
 import streamlit as st
-import pdfplumber
-import google.generativeai as genai
-import json
+import orjson
+import diskcache
 import random
+import re
 import os
+import time
 import hashlib
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from json_repair import repair_json
 
 # ----------------------------
@@ -18,9 +23,53 @@ if not GOOGLE_API_KEY:
     st.error("❌ Missing GEMINI_API_KEY. Set it in Streamlit Cloud secrets or .env.")
     st.stop()
 
-try:
+MODEL_NAME = "gemini-2.5-flash"
+
+# Shared rules and output format for both quiz prompts.
+QUIZ_INSTRUCTIONS = """
+You are a precise JSON generator for a quiz app.
+Generate 8 high-quality Computer Science questions in STRICT, VALID JSON format ONLY,
+based on the Text or on the Topic the user gives.
+
+❗ RULES:
+- Output ONLY the JSON. No intro, no explanation.
+- Use double quotes.
+- 5 MCQ + 3 True/False
+- Include "difficulty": "Easy", "Medium", or "Hard"
+- Include "explanation"
+
+Format:
+{
+  "questions": [
+    {
+      "type": "MCQ",
+      "question": "...",
+      "options": ["A) ...", "B) ...", "C) ...", "D) ..."],
+      "answer": "A",
+      "difficulty": "Medium",
+      "explanation": "..."
+    },
+    {
+      "type": "True/False",
+      "question": "...",
+      "options": ["True", "False"],
+      "answer": "True",
+      "difficulty": "Easy",
+      "explanation": "..."
+    }
+  ]
+}
+"""
+
+@st.cache_resource(show_spinner=False)
+def get_model():
+    import google.generativeai as genai
+
     genai.configure(api_key=GOOGLE_API_KEY)
-    model = genai.GenerativeModel("gemini-2.5-flash")
+    return genai.GenerativeModel(MODEL_NAME, system_instruction=QUIZ_INSTRUCTIONS)
+
+try:
+    model = get_model()
 except Exception as e:
     st.error(f"Failed to initialize Gemini: {e}")
     st.stop()
@@ -33,48 +82,51 @@ st.set_page_config(page_title="CS Quiz Generator", layout="wide")
 # ----------------------------
 # Custom Styling (now safe to call)
 # ----------------------------
+CUSTOM_CSS = """
+<style>
+.stApp {
+    background: linear-gradient(135deg, #6a11cb 0%, #2575fc 100%);
+    color: white;
+}
+section[data-testid="stSidebar"] {
+    background: rgba(255, 255, 255, 0.15) !important;
+    backdrop-filter: blur(10px);
+    border-radius: 16px;
+    border: 1px solid rgba(255, 255, 255, 0.2);
+    margin: 10px;
+}
+.stMarkdown, .stRadio, div[data-testid="stHorizontalBlock"] {
+    background: rgba(255, 255, 255, 0.15) !important;
+    backdrop-filter: blur(10px);
+    border-radius: 16px;
+    border: 1px solid rgba(255, 255, 255, 0.2);
+    padding: 16px;
+    margin-bottom: 16px;
+}
+.stButton > button, div[data-testid="stFormSubmitButton"] > button {
+    background: linear-gradient(90deg, #ff416c, #ff4b2b) !important;
+    color: white !important;
+    border: none !important;
+    border-radius: 12px !important;
+    padding: 12px 24px !important;
+    font-weight: bold !important;
+    transition: transform 0.2s, box-shadow 0.2s;
+}
+.stButton > button:hover, div[data-testid="stFormSubmitButton"] > button:hover {
+    transform: translateY(-2px);
+    box-shadow: 0 6px 20px rgba(255, 75, 43, 0.4) !important;
+}
+.stFileUploader > div > div {
+    background: rgba(255, 255, 255, 0.2) !important;
+    border-radius: 12px !important;
+}
+</style>
+"""
+
 def add_custom_css():
-    st.markdown("""
-    <style>
-    .stApp {
-        background: linear-gradient(135deg, #6a11cb 0%, #2575fc 100%);
-        color: white;
-    }
-    section[data-testid="stSidebar"] {
-        background: rgba(255, 255, 255, 0.15) !important;
-        backdrop-filter: blur(10px);
-        border-radius: 16px;
-        border: 1px solid rgba(255, 255, 255, 0.2);
-        margin: 10px;
-    }
-    .stMarkdown, .stRadio, div[data-testid="stHorizontalBlock"] {
-        background: rgba(255, 255, 255, 0.15) !important;
-        backdrop-filter: blur(10px);
-        border-radius: 16px;
-        border: 1px solid rgba(255, 255, 255, 0.2);
-        padding: 16px;
-        margin-bottom: 16px;
-    }
-    .stButton > button {
-        background: linear-gradient(90deg, #ff416c, #ff4b2b) !important;
-        color: white !important;
-        border: none !important;
-        border-radius: 12px !important;
-        padding: 12px 24px !important;
-        font-weight: bold !important;
-        transition: transform 0.2s, box-shadow 0.2s;
-    }
-    .stButton > button:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 6px 20px rgba(255, 75, 43, 0.4) !important;
-    }
-    .stFileUploader > div > div {
-        background: rgba(255, 255, 255, 0.2) !important;
-        border-radius: 12px !important;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
+# Must run every rerun: Streamlit drops elements a rerun doesn't re-emit.
 add_custom_css()
 
 # ----------------------------
@@ -91,111 +143,175 @@ CS_TOPICS = [
     "Software Engineering and Project Management"
 ]
 
+# PDF text sent to Gemini is capped by an estimated token budget.
+PDF_TOKEN_BUDGET = 2000
+CHARS_PER_TOKEN = 4
+MAX_PDF_CHARS = PDF_TOKEN_BUDGET * CHARS_PER_TOKEN
+QUIZ_SIZE = 8
+QUIZ_HISTORY_SIZE = 100
+SIDEBAR_ICON_URL = "https://cdn-icons-png.flaticon.com/512/860/860792.png"
+
+# Body of a ```json (or bare ```) fence; an unterminated fence runs to the end.
+FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL)
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+
 if "quiz_history" not in st.session_state:
-    st.session_state.quiz_history = []
+    st.session_state.quiz_history = collections.deque(maxlen=QUIZ_HISTORY_SIZE)
+
+if "auto_topic" not in st.session_state:
+    st.session_state.auto_topic = random.choice(CS_TOPICS)
 
 # ----------------------------
 # Helper Functions
 # ----------------------------
-def extract_text_from_pdf(pdf_file):
-    text = ""
+# Cached on the file bytes so widget reruns don't re-parse the same PDF.
+@st.cache_data(show_spinner=False)
+def extract_text_from_pdf(file_bytes):
+    import pypdfium2 as pdfium
+
+    parts = []
+    length = 0
+    # PDFium extracts raw text without layout analysis, which we don't need.
+    pdf = pdfium.PdfDocument(file_bytes)
     try:
-        with pdfplumber.open(pdf_file) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-        return text[:8000]
-    except Exception as e:
-        st.error(f"Error reading PDF: {e}")
-        return ""
+        for page in pdf:
+            textpage = page.get_textpage()
+            try:
+                page_text = textpage.get_text_bounded()
+            finally:
+                textpage.close()
+                page.close()
+            if page_text:
+                parts.append(page_text + "\n")
+                length += len(page_text) + 1
+            # Everything past the cap is discarded, so stop parsing pages.
+            if length >= MAX_PDF_CHARS:
+                break
+    finally:
+        pdf.close()
+    return trim_to_token_budget("".join(parts))
+
+def trim_to_token_budget(text, max_tokens=PDF_TOKEN_BUDGET):
+    # Snap back to a sentence end only if it is close to the limit.
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = 0
+    for match in SENTENCE_END_RE.finditer(text, 0, limit + 1):
+        cut = match.start()
+    return text[:cut] if cut >= limit * 0.8 else text[:limit]
+
+def extract_json(response_text):
+    match = FENCE_RE.search(response_text)
+    json_str = match.group(1).strip() if match else response_text.strip()
 
-def parse_ai_response(response_text):
     try:
-        json_str = response_text.strip()
-        if "```json" in response_text:
-            start = response_text.find("```json") + 7
-            end = response_text.find("```", start)
-            if end == -1:
-                end = len(response_text)
-            json_str = response_text[start:end].strip()
-        elif "```" in response_text:
-            start = response_text.find("```") + 3
-            end = response_text.find("```", start)
-            if end == -1:
-                end = len(response_text)
-            json_str = response_text[start:end].strip()
+        return orjson.loads(json_str)
+    except orjson.JSONDecodeError:
+        return repair_json(json_str, return_objects=True)
+
+def normalize_quiz(parsed):
+    if isinstance(parsed, list):
+        return {"questions": parsed}
+    elif isinstance(parsed, dict):
+        return parsed if "questions" in parsed else {"questions": list(parsed.values()) if parsed else []}
+    else:
+        return {"questions": []}
 
-        try:
-            parsed = json.loads(json_str)
-        except json.JSONDecodeError:
-            parsed = repair_json(json_str, return_objects=True)
-
-        if isinstance(parsed, list):
-            return {"questions": parsed}
-        elif isinstance(parsed, dict):
-            return parsed if "questions" in parsed else {"questions": list(parsed.values()) if parsed else []}
-        else:
-            return {"questions": []}
+def parse_ai_response(response_text):
+    try:
+        return normalize_quiz(extract_json(response_text))
     except Exception:
         return {"questions": []}
 
-def generate_quiz_from_text(text):
-    prompt = f"""
-You are a precise JSON generator for a quiz app.
-Generate 8 high-quality Computer Science questions in STRICT, VALID JSON format ONLY.
-
-❗ RULES:
-- Output ONLY the JSON. No intro, no explanation.
-- Use double quotes.
-- 5 MCQ + 3 True/False
-- Include "difficulty": "Easy", "Medium", or "Hard"
-- Include "explanation"
+def call_with_retry(prompt, timeout=60, retries=2, on_chunk=None):
+    # All attempts share one deadline; only calls that sent nothing are retried.
+    from google.api_core.exceptions import DeadlineExceeded
 
-Format:
-{{
-  "questions": [
-    {{
-      "type": "MCQ",
-      "question": "...",
-      "options": ["A) ...", "B) ...", "C) ...", "D) ..."],
-      "answer": "A",
-      "difficulty": "Medium",
-      "explanation": "..."
-    }},
-    {{
-      "type": "True/False",
-      "question": "...",
-      "options": ["True", "False"],
-      "answer": "True",
-      "difficulty": "Easy",
-      "explanation": "..."
-    }}
-  ]
-}}
+    deadline = time.monotonic() + timeout
+    for attempt in range(retries + 1):
+        if attempt and on_chunk:
+            on_chunk("")
+        full_text = ""
+        try:
+            remaining = deadline - time.monotonic()
+            response = model.generate_content(prompt, stream=True, request_options={"timeout": remaining})
+            for chunk in response:
+                # chunk.text raises on chunks with no parts, e.g. a final usage-only one.
+                parts = chunk.candidates[0].content.parts if chunk.candidates else []
+                if not parts:
+                    continue
+                full_text += "".join(part.text for part in parts)
+                if on_chunk:
+                    on_chunk(full_text)
+            return full_text
+        except (DeadlineExceeded, TimeoutError):
+            backoff = 2 ** attempt
+            if full_text or attempt == retries or deadline - time.monotonic() <= backoff:
+                raise
+            time.sleep(backoff)
+
+# Unlike st.cache_data, this survives restarts and deploys.
+@st.cache_resource(show_spinner=False)
+def get_llm_cache():
+    return diskcache.Cache(".llm_cache", size_limit=100*1024*1024)
+
+def generate_with_progress(prompt):
+    # Everything that shapes the reply goes into the key.
+    key = hashlib.sha256("\0".join((MODEL_NAME, QUIZ_INSTRUCTIONS, prompt)).encode()).digest()
+    llm_cache = get_llm_cache()
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return parse_ai_response(cached)
+
+    bar = st.empty()
+    shown = 0
+
+    def on_chunk(partial_text):
+        nonlocal shown
+        started = min(partial_text.count('"question"'), QUIZ_SIZE)
+        if started != shown:
+            shown = started
+            bar.progress(max(started - 1, 0) / QUIZ_SIZE, text=f"Generating question {max(started, 1)}…")
 
-Text:
-{text}
-"""
     try:
-        response = model.generate_content(prompt, request_options={"timeout": 60})
-        return parse_ai_response(response.text)
-    except Exception as e:
-        st.error(f"AI generation failed: {e}")
-        return {"questions": []}
+        response_text = call_with_retry(prompt, on_chunk=on_chunk)
+    finally:
+        bar.empty()
+    quiz = parse_ai_response(response_text)
+    # Raise on empty replies so neither cache keeps them.
+    if not quiz.get("questions"):
+        raise ValueError("the AI response contained no questions")
+    llm_cache.set(key, response_text, expire=24*60*60)
+    return quiz
+
+def hash_text(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+# Errors propagate to the caller, so failed calls are never cached.
+@st.cache_data(ttl=24*60*60, show_spinner=False)
+def generate_quiz_from_text(text_hash, _text):
+    prompt = f"Text:\n{_text}"
+    return generate_with_progress(prompt)
+
+@st.cache_data(ttl=24*60*60, show_spinner=False)
+def generate_quiz_from_topic(topic_hash, _topic):
+    prompt = f'Topic: "{_topic}"'
+    return generate_with_progress(prompt)
+
+def offer_retry(state_key):
+    if st.session_state[state_key].get("questions"):
+        return
+    if st.button("🔁 Retry", key=f"{state_key}_retry", use_container_width=True):
+        st.session_state.pop(state_key)
+        st.rerun()
 
-def generate_quiz_from_topic(topic):
-    prompt = f"""
-Generate 8 Computer Science questions on: "{topic}".
-5 MCQ + 3 True/False.
-STRICT JSON ONLY.
-"""
-    try:
-        response = model.generate_content(prompt, request_options={"timeout": 60})
-        return parse_ai_response(response.text)
-    except Exception as e:
-        st.error(f"Auto-quiz failed: {e}")
-        return {"questions": []}
+def reset_quiz_state(key_prefix):
+    st.session_state.pop(f"{key_prefix}_results", None)
+    answer_prefix = f"{key_prefix}_q"
+    for key in list(st.session_state):
+        if key.startswith(answer_prefix) and key[len(answer_prefix):].isdigit():
+            del st.session_state[key]
 
 def display_interactive_quiz(quiz_data, key_prefix="quiz", topic="Unknown", quiz_type="Auto"):
     if not isinstance(quiz_data, dict):
@@ -207,41 +323,33 @@ def display_interactive_quiz(quiz_data, key_prefix="quiz", topic="Unknown", quiz
         st.warning("No questions generated.")
         return
 
-    if f"{key_prefix}_user_answers" not in st.session_state:
-        st.session_state[f"{key_prefix}_user_answers"] = [None] * len(questions)
-    user_answers = st.session_state[f"{key_prefix}_user_answers"]
-
-    for i, q in enumerate(questions, 1):
-        st.markdown(f"### Question {i} ({q.get('difficulty', 'N/A')})")
-        st.write(f"**{q.get('question', 'N/A')}**")
-
-        unique_key = f"{key_prefix}_q{i}"
-        options = q.get("options", [])
-        
-        if q.get("type") == "MCQ" and len(options) == 4:
-            index = None
-            if user_answers[i-1] in options:
-                index = options.index(user_answers[i-1])
-            selected = st.radio("", options, key=unique_key, index=index if index is not None else 0, horizontal=True)
-            user_answers[i-1] = selected
-
-        elif q.get("type") == "True/False":
-            current = user_answers[i-1] if user_answers[i-1] in ["True", "False"] else "True"
-            selected = st.radio("", ["True", "False"], key=unique_key, index=0 if current == "True" else 1, horizontal=True)
-            user_answers[i-1] = selected
-        st.divider()
-
-    if st.button("✅ Submit Answers", key=f"{key_prefix}_submit", use_container_width=True):
-        st.session_state[f"{key_prefix}_submitted"] = True
-
-        correct_count = 0
+    with st.form(f"{key_prefix}_form", border=False):
         for i, q in enumerate(questions, 1):
-            user_ans = user_answers[i-1]
-            correct_ans = q.get("answer", "")
-            if user_ans == correct_ans:
-                correct_count += 1
+            st.markdown(f"### Question {i} ({q.get('difficulty', 'N/A')})")
+            st.write(f"**{q.get('question', 'N/A')}**")
+
+            unique_key = f"{key_prefix}_q{i}"
+            options = q.get("options", [])
+            
+            if q.get("type") == "MCQ" and len(options) == 4:
+                st.radio("", options, key=unique_key, index=0, horizontal=True)
+
+            elif q.get("type") == "True/False":
+                st.radio("", ["True", "False"], key=unique_key, index=0, horizontal=True)
+            st.divider()
+
+        submitted = st.form_submit_button("✅ Submit Answers", use_container_width=True)
 
-        score_str = f"{correct_count}/{len(questions)}"
+    results_key = f"{key_prefix}_results"
+    if submitted:
+        # Score once on submit; later reruns just read the stored results.
+        results = [
+            st.session_state.get(f"{key_prefix}_q{i}") == q.get("answer", "")
+            for i, q in enumerate(questions, 1)
+        ]
+        st.session_state[results_key] = results
+
+        score_str = f"{sum(results)}/{len(questions)}"
         st.session_state.quiz_history.append({
             "type": quiz_type,
             "topic": topic,
@@ -249,20 +357,17 @@ def display_interactive_quiz(quiz_data, key_prefix="quiz", topic="Unknown", quiz
             "time": datetime.now().strftime("%H:%M")
         })
 
-    if st.session_state.get(f"{key_prefix}_submitted", False):
-        correct_count = 0
-        for i, q in enumerate(questions, 1):
-            user_ans = user_answers[i-1]
-            correct_ans = q.get("answer", "")
-            is_correct = (user_ans == correct_ans)
+    results = st.session_state.get(results_key)
+    if results is not None:
+        for i, (q, is_correct) in enumerate(zip(questions, results), 1):
             if is_correct:
                 st.success(f"✅ Q{i}: Correct!")
-                correct_count += 1
             else:
-                st.error(f"❌ Q{i}: Incorrect. Correct: **{correct_ans}**")
+                st.error(f"❌ Q{i}: Incorrect. Correct: **{q.get('answer', '')}**")
             st.info(f"**Explanation:** {q.get('explanation', 'N/A')}")
             st.divider()
 
+        correct_count = sum(results)
         st.subheader(f"🎉 Score: {correct_count}/{len(questions)}")
         if correct_count == len(questions):
             st.balloons()
@@ -270,14 +375,27 @@ def display_interactive_quiz(quiz_data, key_prefix="quiz", topic="Unknown", quiz
 # ----------------------------
 # Sidebar: Quiz History
 # ----------------------------
+@st.cache_data(ttl=24*60*60, show_spinner=False)
+def get_sidebar_icon():
+    import requests
+
+    try:
+        response = requests.get(SIDEBAR_ICON_URL, timeout=5)
+        response.raise_for_status()
+        return response.content
+    except requests.RequestException:
+        return None
+
 with st.sidebar:
-    st.image("https://cdn-icons-png.flaticon.com/512/860/860792.png", width=40)
+    icon = get_sidebar_icon()
+    if icon:
+        st.image(icon, width=40)
     st.subheader("📚 Quiz History")
     if st.session_state.quiz_history:
-        for entry in reversed(st.session_state.quiz_history[-5:]):
+        for entry in itertools.islice(reversed(st.session_state.quiz_history), 5):
             st.markdown(f"`{entry['score']}` • {entry['type']} • {entry['topic'][:30]}...")
         if st.button("🗑️ Clear", use_container_width=True):
-            st.session_state.quiz_history = []
+            st.session_state.quiz_history.clear()
             st.rerun()
     else:
         st.info("No attempts yet.")
@@ -293,38 +411,67 @@ st.header("📥 Upload CS PDF")
 uploaded_file = st.file_uploader("Choose a text-based PDF", type="pdf")
 
 if uploaded_file:
-    file_hash = hashlib.md5(uploaded_file.read()).hexdigest()[:8]
-    uploaded_file.seek(0)
+    file_hash = hashlib.blake2b(uploaded_file.getbuffer(), digest_size=8).hexdigest()
     quiz_key = f"pdf_{file_hash}"
 
     with st.spinner("Extracting text..."):
-        text = extract_text_from_pdf(uploaded_file)
+        try:
+            text = extract_text_from_pdf(uploaded_file.getvalue())
+        except Exception as e:
+            st.error(f"Error reading PDF: {e}")
+            text = ""
     
     if text.strip():
+        text_hash = hash_text(text)
+        if "auto_quiz" not in st.session_state and quiz_key not in st.session_state:
+            # The SDK is blocking, so generate both quizzes in worker threads.
+            topic = st.session_state.auto_topic
+            with st.spinner("Generating quizzes…"):
+                with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx,
+                                        initargs=(None, get_script_run_ctx())) as pool:
+                    futures = {
+                        pool.submit(generate_quiz_from_text, text_hash, text): (quiz_key, "AI generation failed"),
+                        pool.submit(generate_quiz_from_topic, hash_text(topic), topic): ("auto_quiz", "Auto-quiz failed"),
+                    }
+                    for future in as_completed(futures):
+                        state_key, error_msg = futures[future]
+                        try:
+                            st.session_state[state_key] = future.result()
+                        except Exception as e:
+                            st.error(f"{error_msg}: {e}")
+                            st.session_state[state_key] = {"questions": []}
+
         if quiz_key not in st.session_state:
             with st.spinner("AI generating quiz..."):
-                quiz = generate_quiz_from_text(text)
-            st.session_state[quiz_key] = quiz
+                try:
+                    st.session_state[quiz_key] = generate_quiz_from_text(text_hash, text)
+                except Exception as e:
+                    st.error(f"AI generation failed: {e}")
+                    st.session_state[quiz_key] = {"questions": []}
         display_interactive_quiz(st.session_state[quiz_key], quiz_key, f"PDF ({file_hash})", "PDF")
+        offer_retry(quiz_key)
     else:
         st.error("Could not extract text. Use a text-based PDF.")
 
 # --- Auto-Generated Quiz Section ---
 st.header("🎲 Daily CS Quiz")
-if "auto_topic" not in st.session_state:
-    st.session_state.auto_topic = random.choice(CS_TOPICS)
-
 if st.button("🔄 New Topic", use_container_width=True):
     st.session_state.auto_topic = random.choice(CS_TOPICS)
     st.session_state.pop("auto_quiz", None)
-    st.session_state.pop("auto_submitted", None)
-    st.session_state.pop("auto_user_answers", None)
+    reset_quiz_state("auto")
     st.rerun()
 
 st.subheader(f"Topic: {st.session_state.auto_topic}")
 
 if "auto_quiz" not in st.session_state:
     with st.spinner("Generating quiz..."):
-        st.session_state.auto_quiz = generate_quiz_from_topic(st.session_state.auto_topic)
-
-display_interactive_quiz(st.session_state.auto_quiz, "auto", st.session_state.auto_topic, "Auto")
\ No newline at end of file
+        try:
+            st.session_state.auto_quiz = generate_quiz_from_topic(
+                hash_text(st.session_state.auto_topic), st.session_state.auto_topic
+            )
+        except Exception as e:
+            st.error(f"Auto-quiz failed: {e}")
+            st.session_state.auto_quiz = {"questions": []}
+
+display_interactive_quiz(st.session_state.auto_quiz, "auto", st.session_state.auto_topic, "Auto")
+offer_retry("auto_quiz")
\ No newline at end of file